@@ -5,28 +5,264 @@ Generates questions and answers based on course PDF files
 """
 
 import os
+import sys
 import json
+import time
+import shutil
+import hashlib
+import tempfile
+import asyncio
+from collections import Counter
+import importlib.util
+from io import StringIO
 import argparse
 from pathlib import Path
-from openai import OpenAI
-import PyPDF2
-import sys
+import multiprocessing
+import multiprocessing.connection
+
+import httpx
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception, RetryError
+
+# Sibling script; resolves because Python puts the script's own directory (scripts/) first on
+# sys.path when this file is run directly, as documented in the README
+from generate_txt_files import TXT_FILE_NAMES, format_questions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+try:
+    # Slower pure-Python fallback for platforms without PyMuPDF wheels (pypdf>=3.17, not in requirements.txt)
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
 
 
 def extract_text_from_pdf(pdf_path):
     """Extract text content from PDF file"""
     try:
-        text = ""
+        if pymupdf is not None:
+            doc = pymupdf.open(pdf_path)
+            try:
+                text = "\n".join(page.get_text() for page in doc)
+            finally:
+                doc.close()
+            return text
+        
+        parts = []
         with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
+            pdf_reader = PdfReader(file)
             for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
+                # extract_text() may return None for pages without a text layer
+                parts.append(page.extract_text() or "")
+        return "\n".join(parts)
     except Exception as e:
         print(f"Error reading PDF file: {e}")
         return None
 
 
+def parse_json(text):
+    """Parse a JSON string, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def read_json(path):
+    """Load a JSON file, using orjson when available"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_json(path, data, indent=True):
+    """Write data as UTF-8 JSON, using orjson when available"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data, option=option))
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2 if indent else None)
+
+
+def write_atomic(path, write):
+    """Call write(tmp_path) on a temporary file next to path, then rename it over path
+    
+    Readers never see a partially written file, even if the process dies mid-write
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def file_hash(path):
+    """SHA-256 hex digest of a file's contents"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class LectureCache:
+    """Content-hash keyed disk cache for extracted PDF text and generated questions"""
+
+    def __init__(self, cache_dir, prompt_template):
+        self.text_dir = Path(cache_dir) / "text"
+        self.questions_dir = Path(cache_dir) / "qs"
+        self.prompt_hash = hashlib.sha256(prompt_template.encode('utf-8')).hexdigest()[:16]
+
+    def _questions_path(self, pdf_hash, model, num_questions):
+        return self.questions_dir / f"{pdf_hash}_{model}_{num_questions}_{self.prompt_hash}.json"
+
+    def load_text(self, pdf_hash):
+        path = self.text_dir / f"{pdf_hash}.txt"
+        if path.exists():
+            return path.read_text(encoding='utf-8')
+        return None
+
+    def save_text(self, pdf_hash, text):
+        self.text_dir.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.text_dir / f"{pdf_hash}.txt", lambda tmp_path: Path(tmp_path).write_text(text, encoding='utf-8'))
+
+    def load_questions(self, pdf_hash, model, num_questions):
+        path = self._questions_path(pdf_hash, model, num_questions)
+        if not path.exists():
+            return None
+        try:
+            return read_json(path)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Warning: Ignoring unreadable cache file {path}: {e}")
+            return None
+
+    def save_questions(self, pdf_hash, model, num_questions, questions_data):
+        self.questions_dir.mkdir(parents=True, exist_ok=True)
+        write_atomic(
+            self._questions_path(pdf_hash, model, num_questions),
+            lambda tmp_path: write_json(tmp_path, questions_data, indent=False)
+        )
+
+
+def dedupe_pdf_files(pdf_files):
+    """Hash every PDF and keep one file per distinct content
+    
+    Returns (unique_files, hashes, aliases): hashes maps each unique file to its content hash,
+    aliases maps each unique file to the list of other files with identical content.
+    """
+    unique_files = []
+    hashes = {}
+    aliases = {}
+    primaries = {}
+    for pdf_path in pdf_files:
+        try:
+            pdf_hash = file_hash(pdf_path)
+        except OSError as e:
+            print(f"Error reading PDF file {pdf_path}: {e}")
+            continue
+        
+        primary = primaries.setdefault(pdf_hash, pdf_path)
+        if primary == pdf_path:
+            unique_files.append(pdf_path)
+            hashes[pdf_path] = pdf_hash
+        else:
+            aliases.setdefault(primary, []).append(pdf_path)
+    return unique_files, hashes, aliases
+
+
+def _extract_text_cached(pdf_path, pdf_hash, cache=None):
+    """Extract the text of a PDF, using the text cache when available"""
+    if cache is not None:
+        text = cache.load_text(pdf_hash)
+        if text is not None:
+            return text
+    
+    text = extract_text_from_pdf(pdf_path)
+    if text and cache is not None:
+        cache.save_text(pdf_hash, text)
+    return text
+
+
+def _extract_worker(conn, pdf_path, pdf_hash, cache):
+    """Child process entry point: extract one PDF and send its text back through conn"""
+    try:
+        conn.send(_extract_text_cached(pdf_path, pdf_hash, cache))
+    finally:
+        conn.close()
+
+
+def extract_all_texts(pdf_files, hashes, cache=None, pdf_timeout=120):
+    """Extract text from all PDF files in parallel across CPU cores
+    
+    Each PDF is parsed in its own worker process. A PDF still running after pdf_timeout
+    seconds (0 disables the limit) has its worker killed and yields None, so a pathological
+    document cannot stall the run. PDF parsing runs in C (PyMuPDF), so killing the process
+    is the only reliable way to stop it; a killed worker never writes to the text cache.
+    
+    Returns a dict mapping each PDF path to its text
+    """
+    ctx = multiprocessing.get_context()
+    max_workers = min(len(pdf_files), os.cpu_count() or 1)
+    pending = list(pdf_files)
+    running = {}  # pdf_path -> (process, receiving end of its pipe, start time)
+    texts = {}
+    
+    while pending or running:
+        while pending and len(running) < max_workers:
+            pdf_path = pending.pop(0)
+            recv_conn, send_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_extract_worker, args=(send_conn, pdf_path, hashes[pdf_path], cache), daemon=True)
+            process.start()
+            send_conn.close()
+            running[pdf_path] = (process, recv_conn, time.monotonic())
+        
+        ready = multiprocessing.connection.wait([conn for _, conn, _ in running.values()], timeout=0.1)
+        for pdf_path, (process, conn, start) in list(running.items()):
+            if conn in ready:
+                try:
+                    texts[pdf_path] = conn.recv()
+                except EOFError:
+                    # The worker died without sending a result; join first so exitcode is set
+                    process.join()
+                    print(f"Error reading PDF file {pdf_path}: extraction process exited with code {process.exitcode}")
+                    texts[pdf_path] = None
+            elif pdf_timeout and time.monotonic() - start > pdf_timeout:
+                print(f"Warning: Skipping {pdf_path}, text extraction took longer than {pdf_timeout}s")
+                process.kill()
+                texts[pdf_path] = None
+            else:
+                continue
+            conn.close()
+            process.join()
+            del running[pdf_path]
+    
+    return texts
+
+
 def load_prompt_template(prompt_path):
     """Load prompt template"""
     try:
@@ -41,112 +277,650 @@ def load_prompt_template(prompt_path):
 MODEL_INFO = {
     "gpt-5": {
         "name": "gpt-5",
+        "context_tokens": 200000,
         "context": "200k+ tokens",
+        "output_tokens": 128000,
         "description": "Latest model with enhanced reasoning and multimodal processing"
     },
     "gpt-4o": {
         "name": "gpt-4o",
+        "context_tokens": 128000,
         "context": "128k tokens",
+        "output_tokens": 16384,
         "description": "Currently recommended, balanced performance and cost"
     },
     "gpt-4-turbo": {
         "name": "gpt-4-turbo",
+        "context_tokens": 128000,
         "context": "128k tokens",
+        "output_tokens": 4096,
         "description": "High-performance model"
     },
     "gpt-4o-mini": {
         "name": "gpt-4o-mini",
+        "context_tokens": 128000,
         "context": "128k tokens",
+        "output_tokens": 16384,
         "description": "More economical option"
     }
 }
 
 
-def generate_questions(lecture_content, num_questions, prompt_template, api_key, model="gpt-4o"):
-    """Generate questions and answers using OpenAI API"""
-    client = OpenAI(api_key=api_key)
+# Context tokens kept free for the system prompt, instructions and the model's answer
+OUTPUT_TOKEN_RESERVE = 16000
+
+# Rough size of one generated question with its answer, used to size a response's output
+OUTPUT_TOKENS_PER_QUESTION = 300
+
+
+# tiktoken encodings per model, filled by load_encodings before any request is made
+_ENCODINGS = {}
+
+
+def load_encodings(models):
+    """Load the tiktoken encoding of each model up front
     
-    # Display model information being used
-    if model in MODEL_INFO:
-        info = MODEL_INFO[model]
-        print(f"Using model: {info['name']} (Context: {info['context']})")
+    tiktoken downloads an encoding on first use, which would otherwise block the event loop
+    mid-run and fail without network access. Models whose encoding cannot be loaded fall back
+    to the ~4 characters per token estimate.
+    """
+    if tiktoken is None:
+        return
+    for model in models:
+        if not model or model in _ENCODINGS:
+            continue
+        try:
+            try:
+                _ENCODINGS[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Models newer than the installed tiktoken
+                _ENCODINGS[model] = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"Warning: Could not load the tiktoken encoding for {model} ({e}), estimating ~4 characters per token")
+
+
+def count_tokens(text, model):
+    """Number of tokens in text for the given model (~4 characters per token without its encoding)"""
+    enc = _ENCODINGS.get(model)
+    if enc is None:
+        return len(text) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model):
+    """Truncate text to at most max_tokens tokens, returning (text, was_truncated)"""
+    enc = _ENCODINGS.get(model)
+    if enc is None:
+        max_chars = max_tokens * 4
+        return text[:max_chars], len(text) > max_chars
     
-    # Build complete prompt
-    prompt = prompt_template.format(num_questions=num_questions) + "\n\n" + lecture_content
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text, False
+    return enc.decode(tokens[:max_tokens]), True
+
+
+def fit_lectures_to_context(lecture_contents, instructions, model, num_questions=0):
+    """Trim lectures so that all of them plus the instructions fit the model's context window, each with an equal share
+    
+    The room left for the answer grows with the num_questions generated for each lecture
+    """
+    if model not in MODEL_INFO:
+        return list(lecture_contents)
     
+    num_lectures = len(lecture_contents)
+    reserve = max(OUTPUT_TOKEN_RESERVE, num_lectures * num_questions * OUTPUT_TOKENS_PER_QUESTION)
+    budget = MODEL_INFO[model]["context_tokens"] - reserve - count_tokens(instructions, model)
+    budget = max(budget // num_lectures, 0)
+    fitted = []
+    for lecture_content in lecture_contents:
+        lecture_content, truncated = truncate_to_tokens(lecture_content, budget, model)
+        if truncated:
+            print(f"Warning: Lecture content exceeds the context window of {model}, truncated to {budget} tokens")
+        fitted.append(lecture_content)
+    return fitted
+
+
+def max_batch_size(model, num_questions):
+    """Largest number of lectures whose questions fit in one response of model, or None if unknown"""
+    if model not in MODEL_INFO:
+        return None
+    return max(1, MODEL_INFO[model]["output_tokens"] // max(1, num_questions * OUTPUT_TOKENS_PER_QUESTION))
+
+
+class RateLimiter:
+    """Token-bucket limiter gating both requests and tokens per minute"""
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = float(max_requests_per_minute)
+        self.available_token_capacity = float(max_tokens_per_minute)
+        self.last_update_time = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60.0,
+            self.max_requests_per_minute
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60.0,
+            self.max_tokens_per_minute
+        )
+        self.last_update_time = now
+
+    async def acquire(self, est_tokens):
+        """Wait until both buckets have capacity, then consume it"""
+        # A single request larger than the whole bucket would otherwise wait forever
+        est_tokens = min(est_tokens, self.max_tokens_per_minute)
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= est_tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= est_tokens
+                return
+            await asyncio.sleep(0.001)
+
+
+# Total tries per API request, including the first
+MAX_ATTEMPTS = 5
+
+_backoff = wait_random_exponential(min=1, max=60)
+
+
+def _wait_retry_after(retry_state):
+    """Honor the Retry-After header of 429 responses, otherwise back off exponentially with jitter"""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, RateLimitError):
+        retry_after = exc.response.headers.get("retry-after")
+        try:
+            return min(float(retry_after), 60)
+        except (TypeError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+
+def _is_transient(exc):
+    """Whether an API error is worth retrying"""
+    if isinstance(exc, RateLimitError):
+        # A 429 for an exhausted quota will not clear by waiting
+        return getattr(exc, "code", None) != "insufficient_quota"
+    # A stream dropped mid-response surfaces as a raw httpx error (e.g. RemoteProtocolError,
+    # ReadError) rather than an APIConnectionError, so retry those too
+    return isinstance(exc, (APIConnectionError, APITimeoutError, InternalServerError, httpx.TransportError))
+
+
+def _log_retry(retry_state):
+    exc = retry_state.outcome.exception()
+    print(f"Transient API error ({type(exc).__name__}), retrying (attempt {retry_state.attempt_number}/{MAX_ATTEMPTS})...")
+
+
+@retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    retry=retry_if_exception(_is_transient),
+    before_sleep=_log_retry
+)
+async def _acreate_chat(client, sem, limiter, est_tokens, **kwargs):
+    """Single streamed chat completion call returning (the forced tool call's arguments, finish_reason), retried on transient errors"""
+    # Bound the number of in-flight requests across all lectures;
+    # backoff sleeps happen outside the semaphore
+    async with sem:
+        await limiter.acquire(est_tokens)
+        stream = await client.chat.completions.create(stream=True, **kwargs)
+        # Consume the stream inside the retry so a dropped connection re-issues the request
+        buf = StringIO()
+        finish_reason = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            # Set on the last chunk only
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            for tool_call in choice.delta.tool_calls or ():
+                if tool_call.index == 0 and tool_call.function and tool_call.function.arguments:
+                    buf.write(tool_call.function.arguments)
+        return buf.getvalue(), finish_reason
+
+
+SYSTEM_PROMPT = "You are a helpful teaching assistant that generates exam questions based on lecture content. Always respond by calling the emit_questions function."
+
+BATCH_SYSTEM_PROMPT = "You are a helpful teaching assistant that generates exam questions based on lecture content. Always respond by calling the emit_lecture_questions function, with one entry per lecture."
+
+# Appended after the prompt template when several lectures share one request
+BATCH_INSTRUCTIONS = """The content below contains {count} separate lectures, each starting with a ===LECTURE i=== marker.
+Apply the instructions above to each lecture independently.
+Return the result through emit_lecture_questions, with one entry per lecture in "lectures", where "id" is the lecture number from its marker and "questions" follows the format described above."""
+
+# Expected shape of a single lecture's questions
+QUESTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "questions": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "question": {"type": "string"},
+                    "answer": {"type": "string"}
+                },
+                "required": ["question", "answer"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["questions"],
+    "additionalProperties": False
+}
+
+# Expected shape of a batched response covering several lectures
+BATCH_QUESTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "lectures": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "questions": QUESTIONS_SCHEMA["properties"]["questions"]
+                },
+                "required": ["id", "questions"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["lectures"],
+    "additionalProperties": False
+}
+
+# Function tools the model is forced to call; strict mode makes the API enforce the schema
+QUESTIONS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "emit_questions",
+        "description": "Record the exam questions and answers generated for the lecture",
+        "parameters": QUESTIONS_SCHEMA,
+        "strict": True
+    }
+}
+
+BATCH_QUESTIONS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "emit_lecture_questions",
+        "description": "Record the exam questions and answers generated for each lecture",
+        "parameters": BATCH_QUESTIONS_SCHEMA,
+        "strict": True
+    }
+}
+
+
+async def _request_json(instructions, content, system_prompt, tool, client, sem, limiter, model):
+    """Send instructions and lecture content to the OpenAI API, forcing a call to tool, and parse its arguments
+    
+    The instructions go in their own message ahead of the content, so every request
+    shares an identical prefix that the server can serve from its prompt cache.
+    """
     try:
-        response = client.chat.completions.create(
+        result, finish_reason = await _acreate_chat(
+            client,
+            sem,
+            limiter,
+            (len(instructions) + len(content)) // 4,  # Rough token estimate (~4 characters per token) for TPM accounting
             model=model,
             messages=[
                 {
                     "role": "system",
-                    "content": "You are a helpful teaching assistant that generates exam questions based on lecture content. Always respond with valid JSON format containing a 'questions' array."
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": instructions
                 },
                 {
                     "role": "user",
-                    "content": prompt
+                    "content": content
                 }
             ],
             temperature=1,
-            response_format={"type": "json_object"}  # Ensure JSON format response
+            tools=[tool],
+            tool_choice={"type": "function", "function": {"name": tool["function"]["name"]}},
+            parallel_tool_calls=False
         )
         
-        result = response.choices[0].message.content
-        questions_data = json.loads(result)
-        
-        # Validate JSON format
-        if "questions" not in questions_data:
-            print("Warning: Returned JSON format is incorrect, missing 'questions' field")
-            # If returned data is a questions array, convert to standard format
-            if isinstance(questions_data, list):
-                questions_data = {"questions": questions_data}
-            else:
-                return None
-        
-        return questions_data
+        if finish_reason == "length":
+            print(f"Error: Response was cut off at the output token limit of {model} ({len(result)} characters received), request fewer questions or lectures per request")
+            return None
+        return parse_json(result)
     except json.JSONDecodeError as e:
         print(f"Error parsing JSON: {e}")
         if 'result' in locals():
             print(f"Returned content: {result[:500]}...")  # Print first 500 characters for debugging
         return None
+    except RetryError as e:
+        print(f"Error calling OpenAI API: giving up after {e.last_attempt.attempt_number} attempts: {e.last_attempt.exception()}")
+        return None
     except Exception as e:
         print(f"Error calling OpenAI API: {e}")
         return None
 
 
-def process_lecture(pdf_path, num_questions, prompt_template, api_key, output_dir, model="gpt-4o"):
-    """Process a single lecture PDF file"""
+def validate_questions(questions_data):
+    """Check questions_data against QUESTIONS_SCHEMA, printing the first problem found"""
+    if jsonschema is not None:
+        try:
+            jsonschema.validate(questions_data, QUESTIONS_SCHEMA)
+            return True
+        except jsonschema.ValidationError as e:
+            print(f"Warning: Returned questions failed validation: {e.message}")
+            return False
+    
+    # Minimal equivalent check without jsonschema
+    questions = questions_data.get("questions") if isinstance(questions_data, dict) else None
+    if (
+        isinstance(questions, list) and questions
+        and all(isinstance(item, dict) and isinstance(item.get("question"), str) and isinstance(item.get("answer"), str) for item in questions)
+    ):
+        return True
+    print("Warning: Returned questions failed validation")
+    return False
+
+
+async def generate_questions(lecture_content, instructions, client, sem, limiter, model="gpt-4o", num_questions=0):
+    """Generate questions and answers using OpenAI API
+    
+    instructions is the prompt template already formatted with num_questions, which also sizes
+    the room kept free for the answer
+    """
+    # Display model information being used
+    if model in MODEL_INFO:
+        info = MODEL_INFO[model]
+        print(f"Using model: {info['name']} (Context: {info['context']})")
+    
+    # Trim the lecture so the request is not rejected for length; tokenizing is CPU-bound,
+    # so it runs off the event loop
+    [lecture_content] = await asyncio.to_thread(fit_lectures_to_context, [lecture_content], instructions, model, num_questions)
+    
+    questions_data = await _request_json(instructions, lecture_content, SYSTEM_PROMPT, QUESTIONS_TOOL, client, sem, limiter, model)
+    if questions_data is None or not validate_questions(questions_data):
+        return None
+    return questions_data
+
+
+async def generate_with_fallback(lecture_content, instructions, client, sem, limiter, model, fallback_model=None, stats=None, num_questions=0):
+    """Generate questions with model, re-issuing once against fallback_model if that fails
+    
+    Returns (questions_data, the model that produced them).
+    stats, if given, is a Counter of successful generations per model
+    """
+    questions_data = await generate_questions(lecture_content, instructions, client, sem, limiter, model, num_questions)
+    used_model = model
+    if questions_data is None and fallback_model and fallback_model != model:
+        print(f"Retrying with fallback model: {fallback_model}")
+        questions_data = await generate_questions(lecture_content, instructions, client, sem, limiter, fallback_model, num_questions)
+        used_model = fallback_model
+    
+    if questions_data is not None and stats is not None:
+        stats[used_model] += 1
+    return questions_data, used_model
+
+
+async def generate_questions_batch(lecture_contents, instructions, client, sem, limiter, model="gpt-4o", num_questions=0):
+    """Generate questions for several lectures with a single API request
+    
+    Returns a list aligned with lecture_contents, with None for lectures missing from the response
+    """
+    if model in MODEL_INFO:
+        info = MODEL_INFO[model]
+        print(f"Using model: {info['name']} (Context: {info['context']})")
+    
+    # Build one message containing every lecture, delimited by ===LECTURE i=== markers;
+    # each lecture gets an equal share of the context window left after the answers
+    instructions = instructions + "\n\n" + BATCH_INSTRUCTIONS.format(count=len(lecture_contents))
+    fitted = await asyncio.to_thread(fit_lectures_to_context, lecture_contents, instructions, model, num_questions)
+    sections = [f"===LECTURE {i}===\n{content}" for i, content in enumerate(fitted, start=1)]
+    
+    results = [None] * len(lecture_contents)
+    batch_data = await _request_json(instructions, "\n\n".join(sections), BATCH_SYSTEM_PROMPT, BATCH_QUESTIONS_TOOL, client, sem, limiter, model)
+    if batch_data is None:
+        return results
+    
+    if not isinstance(batch_data, dict) or not isinstance(batch_data.get("lectures"), list):
+        print("Warning: Returned JSON format is incorrect, missing 'lectures' field")
+        return results
+    
+    # Fan the combined response out to per-lecture results
+    for entry in batch_data["lectures"]:
+        try:
+            idx = int(entry["id"]) - 1
+        except (KeyError, TypeError, ValueError):
+            print("Warning: Skipping lecture entry without a valid 'id'")
+            continue
+        if 0 <= idx < len(results):
+            questions_data = {"questions": entry.get("questions")}
+            if validate_questions(questions_data):
+                results[idx] = questions_data
+    
+    return results
+
+
+def save_questions(questions_data, pdf_path, output_dir, aliases=()):
+    """Save a lecture's questions as a JSON file in output_dir, returning the number of files written
+    
+    aliases are other PDF files with identical content, which get a copy of the same questions
+    """
+    pdf_name = Path(pdf_path).stem
+    output_path = Path(output_dir) / f"{pdf_name}.json"
+    
+    # Ensure output directory exists
+    output_dir_path = Path(output_dir)
+    output_dir_path.mkdir(parents=True, exist_ok=True)
+    
+    write_json(output_path, questions_data)
+    
+    print(f"Saved questions to: {output_path}")
+    
+    for alias in aliases:
+        alias_path = output_dir_path / f"{Path(alias).stem}.json"
+        shutil.copyfile(output_path, alias_path)
+        print(f"Saved questions for duplicate {alias} to: {alias_path}")
+    return 1 + len(aliases)
+
+
+async def process_lecture(pdf_path, lecture_content, pdf_hash, num_questions, instructions, client, sem, limiter, cache=None, model="gpt-4o", fallback_model=None, stats=None):
+    """Process a single lecture PDF file, given its pre-extracted text and content hash
+    
+    Returns [(pdf_path, questions_data)], with questions_data None on failure
+    """
     print(f"Processing: {pdf_path}")
     
-    # Extract PDF text
-    lecture_content = extract_text_from_pdf(pdf_path)
     if not lecture_content:
         print(f"Unable to extract PDF content: {pdf_path}")
-        return False
+        return [(pdf_path, None)]
     
     print(f"Extracted {len(lecture_content)} characters of text content")
     
+    # Reuse questions generated earlier by the requested model for identical input
+    if cache is not None:
+        questions_data = await asyncio.to_thread(cache.load_questions, pdf_hash, model, num_questions)
+        if questions_data:
+            print(f"Using cached questions: {pdf_path}")
+            if stats is not None:
+                stats[model] += 1
+            return [(pdf_path, questions_data)]
+    
     # Generate questions
     print(f"Generating {num_questions} questions...")
-    questions_data = generate_questions(lecture_content, num_questions, prompt_template, api_key, model)
+    questions_data, used_model = await generate_with_fallback(lecture_content, instructions, client, sem, limiter, model, fallback_model, stats, num_questions)
     
     if not questions_data:
         print(f"Failed to generate questions: {pdf_path}")
-        return False
+        return [(pdf_path, None)]
     
-    # Save as JSON file
-    pdf_name = Path(pdf_path).stem
-    output_path = Path(output_dir) / f"{pdf_name}.json"
+    # Cache under the model that actually produced the questions
+    if cache is not None:
+        await asyncio.to_thread(cache.save_questions, pdf_hash, used_model, num_questions, questions_data)
+    return [(pdf_path, questions_data)]
+
+
+async def process_lecture_batch(pdf_paths, texts, hashes, num_questions, instructions, client, sem, limiter, cache=None, model="gpt-4o", fallback_model=None, stats=None):
+    """Process several lecture PDF files with a single API request
     
-    # Ensure output directory exists
-    output_dir_path = Path(output_dir)
-    output_dir_path.mkdir(parents=True, exist_ok=True)
+    texts and hashes map each PDF path to its pre-extracted text and content hash.
+    Returns a list of (pdf_path, questions_data), with questions_data None on failure
+    """
+    results = []
+    pdf_paths_ok = []
+    lecture_contents = []
+    for pdf_path in pdf_paths:
+        print(f"Processing: {pdf_path}")
+        lecture_content = texts[pdf_path]
+        if not lecture_content:
+            print(f"Unable to extract PDF content: {pdf_path}")
+            results.append((pdf_path, None))
+            continue
+        print(f"Extracted {len(lecture_content)} characters of text content")
+        
+        # Reuse questions generated earlier by the requested model for identical input
+        if cache is not None:
+            questions_data = await asyncio.to_thread(cache.load_questions, hashes[pdf_path], model, num_questions)
+            if questions_data:
+                print(f"Using cached questions: {pdf_path}")
+                if stats is not None:
+                    stats[model] += 1
+                results.append((pdf_path, questions_data))
+                continue
+        
+        pdf_paths_ok.append(pdf_path)
+        lecture_contents.append(lecture_content)
     
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(questions_data, f, ensure_ascii=False, indent=2)
+    if not lecture_contents:
+        return results
     
-    print(f"Saved questions to: {output_path}")
-    return True
+    print(f"Generating {num_questions} questions for each of {len(lecture_contents)} lectures in one request...")
+    batch_results = await generate_questions_batch(lecture_contents, instructions, client, sem, limiter, model, num_questions)
+    
+    for pdf_path, lecture_content, questions_data in zip(pdf_paths_ok, lecture_contents, batch_results):
+        used_model = model
+        if questions_data is None and fallback_model and fallback_model != model:
+            # Re-issue lectures missing or invalid in the batch response individually
+            print(f"Retrying with fallback model {fallback_model}: {pdf_path}")
+            questions_data = await generate_questions(lecture_content, instructions, client, sem, limiter, fallback_model, num_questions)
+            used_model = fallback_model
+        
+        if not questions_data:
+            print(f"Failed to generate questions: {pdf_path}")
+            results.append((pdf_path, None))
+            continue
+        if stats is not None:
+            stats[used_model] += 1
+        # Cache under the model that actually produced the questions
+        if cache is not None:
+            await asyncio.to_thread(cache.save_questions, hashes[pdf_path], used_model, num_questions, questions_data)
+        results.append((pdf_path, questions_data))
+    return results
+
+
+async def write_txt_incrementally(queue, output_dir):
+    """Consume (source, questions_data) items from queue, appending them to the txt files as they arrive
+    
+    Questions are numbered in arrival order; a None item ends the stream.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    files = [open(output_dir / name, 'w', encoding='utf-8') for name in TXT_FILE_NAMES]
+    count = 0
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            source, questions_data = item
+            questions = [
+                {"question": q["question"], "answer": q["answer"], "source": source}
+                for q in questions_data["questions"]
+            ]
+            for f, buf in zip(files, format_questions(questions, start=count + 1)):
+                await asyncio.to_thread(f.write, "".join(buf))
+            count += len(questions)
+    finally:
+        for f in files:
+            f.close()
+    print(f"Wrote {count} questions to txt files in: {output_dir}")
+
+
+def create_client(api_key, concurrency):
+    """Create the API client shared by all requests, reusing keep-alive connections"""
+    limits = httpx.Limits(max_connections=max(64, concurrency), max_keepalive_connections=max(64, concurrency))
+    # HTTP/2 multiplexes requests over one connection, but needs the optional h2 package
+    http2 = importlib.util.find_spec("h2") is not None
+    return AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,  # Retries are handled by _acreate_chat, disable the SDK's built-in ones
+        http_client=httpx.AsyncClient(limits=limits, http2=http2)
+    )
+
+
+async def run_all(pdf_files, texts, hashes, args, prompt_template, api_key, cache=None, stats=None, aliases=None):
+    """Dispatch all lectures concurrently, bounded by --concurrency, returning the number of JSON files written
+    
+    Each lecture's questions are written to disk as soon as its response arrives,
+    and optionally streamed into the txt files (--txt-dir).
+    """
+    aliases = aliases or {}
+    sem = asyncio.Semaphore(max(1, args.concurrency))
+    limiter = RateLimiter(args.max_requests_per_minute, args.max_tokens_per_minute)
+    batch_size = max(1, args.batch_size)
+    # All of a batch's questions come back in one response, bounded by the model's output limit
+    batch_limit = max_batch_size(args.model, args.num_questions)
+    if batch_limit is not None and batch_size > batch_limit:
+        print(f"Warning: {args.num_questions} questions for {batch_size} lectures exceed the output limit of {args.model}, using a batch size of {batch_limit}")
+        batch_size = batch_limit
+    if args.model in MODEL_INFO and args.num_questions * OUTPUT_TOKENS_PER_QUESTION > MODEL_INFO[args.model]["output_tokens"]:
+        print(f"Warning: {args.num_questions} questions per lecture may exceed the output limit of {args.model}, responses may be cut off")
+    fallback_model = None if args.fallback_model == 'none' else args.fallback_model
+    # Format the static instructions once; they are sent unchanged with every lecture
+    instructions = prompt_template.format(num_questions=args.num_questions)
+    
+    txt_queue = None
+    if args.txt_dir:
+        txt_queue = asyncio.Queue()
+        txt_writer = asyncio.create_task(write_txt_incrementally(txt_queue, args.txt_dir))
+    
+    success_count = 0
+    async with create_client(api_key, args.concurrency) as client:
+        if batch_size == 1:
+            tasks = [
+                process_lecture(pdf_path, texts[pdf_path], hashes[pdf_path], args.num_questions, instructions, client, sem, limiter, cache, args.model, fallback_model, stats)
+                for pdf_path in pdf_files
+            ]
+        else:
+            # Pack batch_size lectures into each request
+            tasks = [
+                process_lecture_batch(pdf_files[i:i + batch_size], texts, hashes, args.num_questions, instructions, client, sem, limiter, cache, args.model, fallback_model, stats)
+                for i in range(0, len(pdf_files), batch_size)
+            ]
+        
+        for coro in asyncio.as_completed(tasks):
+            for pdf_path, questions_data in await coro:
+                if not questions_data:
+                    continue
+                pdf_aliases = aliases.get(pdf_path, ())
+                # File writes run off the event loop so in-flight requests keep streaming
+                success_count += await asyncio.to_thread(save_questions, questions_data, pdf_path, args.output_dir, pdf_aliases)
+                if txt_queue is not None:
+                    for path in (pdf_path, *pdf_aliases):
+                        await txt_queue.put((Path(path).stem, questions_data))
+    
+    if txt_queue is not None:
+        await txt_queue.put(None)
+        await txt_writer
+    return success_count
 
 
 def main():
@@ -188,9 +962,62 @@ def main():
     parser.add_argument(
         '--model',
         type=str,
-        default='gpt-5',
+        default='gpt-4o-mini',
         choices=list(MODEL_INFO.keys()),
-        help='Model to use (default: gpt-4o). Options: gpt-5 (latest, 200k+ tokens), gpt-4o (recommended, 128k tokens), gpt-4-turbo (128k tokens), gpt-4o-mini (economical, 128k tokens)'
+        help='Model to use (default: gpt-4o-mini). Options: gpt-5 (latest, 200k+ tokens), gpt-4o (recommended, 128k tokens), gpt-4-turbo (128k tokens), gpt-4o-mini (economical, 128k tokens)'
+    )
+    parser.add_argument(
+        '--fallback-model',
+        type=str,
+        default='gpt-4o',
+        choices=list(MODEL_INFO.keys()) + ['none'],
+        help='Model retried once when --model fails or returns invalid questions, "none" to disable (default: gpt-4o)'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=8,
+        help='Maximum number of concurrent API requests (default: 8)'
+    )
+    parser.add_argument(
+        '--max-requests-per-minute',
+        type=float,
+        default=500,
+        help='Request rate limit applied before each API call (default: 500)'
+    )
+    parser.add_argument(
+        '--max-tokens-per-minute',
+        type=float,
+        default=200000,
+        help='Token rate limit applied before each API call (default: 200000)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help='Number of lectures packed into a single API request, useful when the request rate limit is the bottleneck (default: 1)'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default='.cache',
+        help='Directory caching extracted text and generated questions (default: .cache)'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Disable the cache: always re-extract PDFs and call the API'
+    )
+    parser.add_argument(
+        '--extract-timeout',
+        type=float,
+        default=120,
+        help='Skip PDF files whose text extraction takes longer than this many seconds, 0 to disable (default: 120)'
+    )
+    parser.add_argument(
+        '--txt-dir',
+        type=str,
+        help='Also write questions.txt/answers.txt/questions_and_answers.txt to this directory as lectures complete (numbered in completion order)'
     )
     
     args = parser.parse_args()
@@ -207,6 +1034,10 @@ def main():
         print(f"Error: Unable to load prompt file: {args.prompt_file}")
         sys.exit(1)
     
+    if pymupdf is None and PdfReader is None:
+        print("Error: No PDF library available, please install pymupdf (or pypdf>=3.17 as a fallback)")
+        sys.exit(1)
+    
     # Get PDF file list
     slices_dir = Path(args.slices_dir)
     if not slices_dir.exists():
@@ -238,14 +1069,26 @@ def main():
     else:
         print(f"Using model: {args.model}\n")
     
-    # Process each PDF file
-    success_count = 0
-    for pdf_path in pdf_files:
-        if process_lecture(pdf_path, args.num_questions, prompt_template, api_key, args.output_dir, args.model):
-            success_count += 1
-        print()  # Empty line separator
+    # Identical PDFs (e.g. re-uploads) are processed once and their questions copied
+    unique_files, hashes, aliases = dedupe_pdf_files(pdf_files)
+    duplicate_count = sum(len(dups) for dups in aliases.values())
+    if duplicate_count:
+        print(f"Skipping {duplicate_count} duplicate PDF files ({len(unique_files)} unique)")
+    if not unique_files:
+        print("Error: No readable PDF files")
+        sys.exit(1)
+    
+    # Extract all PDF texts up front, then generate questions concurrently
+    print(f"Extracting text from {len(unique_files)} PDF files...")
+    cache = None if args.no_cache else LectureCache(args.cache_dir, prompt_template)
+    texts = extract_all_texts(unique_files, hashes, cache, args.extract_timeout)
+    load_encodings((args.model, None if args.fallback_model == 'none' else args.fallback_model))
+    stats = Counter()
+    success_count = asyncio.run(run_all(unique_files, texts, hashes, args, prompt_template, api_key, cache, stats, aliases))
     
-    print(f"Complete! Successfully processed {success_count}/{len(pdf_files)} files")
+    print(f"\nComplete! Successfully processed {success_count}/{len(pdf_files)} files")
+    for model, count in stats.most_common():
+        print(f"  {model}: {count} lectures generated (including cached)")
 
 
 if __name__ == '__main__':
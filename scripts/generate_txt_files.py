@@ -6,14 +6,78 @@ Read all JSON files from the questions folder and generate three txt files:
 3. questions_and_answers.txt - Questions and answers appear adjacent (with numbering)
 """
 
+import os
 import json
 import argparse
+import itertools
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Output files written by generate_txt_files: questions only, answers only, and both
+TXT_FILE_NAMES = ("questions.txt", "answers.txt", "questions_and_answers.txt")
+
+# Exceptions raised on malformed JSON by whichever parser is in use
+JSON_ERRORS = (json.JSONDecodeError,) + ((ijson.JSONError,) if ijson is not None else ())
+
+
+def _iter_question_items(json_file):
+    """Yield the entries of a JSON file's "questions" array
+    
+    With ijson the array is streamed item by item instead of loading the whole document.
+    """
+    if ijson is not None:
+        # Binary mode lets ijson use its C (yajl2_c) backend
+        with open(json_file, 'rb') as f:
+            yield from ijson.items(f, "questions.item")
+        return
+    
+    if orjson is not None:
+        with open(json_file, 'rb') as f:
+            data = orjson.loads(f.read())
+    else:
+        with open(json_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    
+    if "questions" in data:
+        yield from data["questions"]
+
+
+def _load_one(json_file):
+    """Load questions and answers from a single JSON file"""
+    try:
+        # Extract questions and answers
+        file_questions = []
+        for item in _iter_question_items(json_file):
+            if "question" in item and "answer" in item:
+                file_questions.append({
+                    "question": item["question"],
+                    "answer": item["answer"],
+                    "source": json_file.stem
+                })
+        
+        if not file_questions:
+            print(f"Warning: No questions found in {json_file}")
+        return file_questions
+        
+    except JSON_ERRORS as e:
+        print(f"Error: Unable to parse {json_file}: {e}")
+    except Exception as e:
+        print(f"Error: Error reading {json_file}: {e}")
+    return []
 
 
 def load_all_questions(questions_dir):
     """Load questions and answers from all JSON files"""
-    all_questions = []
     questions_dir = Path(questions_dir)
     
     # Get all JSON files and sort by filename
@@ -25,58 +89,74 @@ def load_all_questions(questions_dir):
     
     print(f"Found {len(json_files)} JSON files")
     
-    for json_file in json_files:
-        try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            # Extract questions and answers
-            if "questions" in data:
-                for item in data["questions"]:
-                    if "question" in item and "answer" in item:
-                        all_questions.append({
-                            "question": item["question"],
-                            "answer": item["answer"],
-                            "source": json_file.stem
-                        })
-            else:
-                print(f"Warning: No 'questions' field found in {json_file}")
-                
-        except json.JSONDecodeError as e:
-            print(f"Error: Unable to parse {json_file}: {e}")
-        except Exception as e:
-            print(f"Error: Error reading {json_file}: {e}")
+    # Read files concurrently; map preserves the filename order
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        results = list(ex.map(_load_one, json_files))
+    all_questions = list(itertools.chain.from_iterable(results))
     
     print(f"Loaded {len(all_questions)} questions in total")
     return all_questions
 
 
+def _write_chunks(path, chunks):
+    """Write a list of strings to path, using a single writev() call per IOV_MAX chunks on POSIX"""
+    if not hasattr(os, "writev"):
+        with open(path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.write("".join(chunks))
+        return
+    
+    try:
+        iov_max = os.sysconf("SC_IOV_MAX")
+    except (ValueError, OSError):
+        iov_max = 1024
+    if iov_max <= 0:
+        iov_max = 1024
+    
+    iov = [chunk.encode('utf-8') for chunk in chunks]
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        for start in range(0, len(iov), iov_max):
+            batch = iov[start:start + iov_max]
+            written = os.writev(fd, batch)
+            # writev may write less than requested; finish the remainder
+            remaining = b"".join(batch)[written:] if written < sum(map(len, batch)) else b""
+            while remaining:
+                remaining = remaining[os.write(fd, remaining):]
+    finally:
+        os.close(fd)
+
+
+def format_questions(questions, start=1):
+    """Format questions into the text chunks of the three txt files, numbered from start
+    
+    Returns (questions chunks, answers chunks, questions+answers chunks)
+    """
+    q_buf, a_buf, qa_buf = [], [], []
+    for idx, item in enumerate(questions, start=start):
+        question = item["question"]
+        answer = item["answer"]
+        
+        # Questions file
+        q_buf.append(f"{idx}. {question}\n\n")
+        
+        # Answers file
+        a_buf.append(f"{idx}. {answer}\n\n")
+        
+        # Questions+answers file
+        qa_buf.append(f"{idx}. {question}\nA: {answer}\n\n")
+    return q_buf, a_buf, qa_buf
+
+
 def generate_txt_files(all_questions, output_dir):
     """Generate three txt files"""
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    questions_file = output_dir / "questions.txt"
-    answers_file = output_dir / "answers.txt"
-    qa_file = output_dir / "questions_and_answers.txt"
+    questions_file, answers_file, qa_file = (output_dir / name for name in TXT_FILE_NAMES)
     
-    with open(questions_file, 'w', encoding='utf-8') as fq, \
-         open(answers_file, 'w', encoding='utf-8') as fa, \
-         open(qa_file, 'w', encoding='utf-8') as fqa:
-        
-        for idx, item in enumerate(all_questions, start=1):
-            question = item["question"]
-            answer = item["answer"]
-            
-            # Write to questions file
-            fq.write(f"{idx}. {question}\n\n")
-            
-            # Write to answers file
-            fa.write(f"{idx}. {answer}\n\n")
-            
-            # Write to questions+answers file
-            fqa.write(f"{idx}. {question}\n")
-            fqa.write(f"A: {answer}\n\n")
+    # Build each file's content in memory and write it with as few syscalls as possible
+    for path, buf in zip((questions_file, answers_file, qa_file), format_questions(all_questions)):
+        _write_chunks(path, buf)
     
     print(f"\nGenerated files:")
     print(f"  - {questions_file}")